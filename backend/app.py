@@ -7,21 +7,71 @@ Provides REST API endpoints for GPT-2 model analysis including:
 - Attention weight computation
 - Next token prediction
 
-Uses transformers library with GPT-2 model and sklearn for PCA.
+Uses transformers library with GPT-2 model and torch.pca_lowrank for PCA.
 """
 
+import asyncio
+import contextlib
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from functools import cache, lru_cache
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+# Thread pools are sized from the environment when torch loads (transformers
+# imports it), so these must be set before the imports below. Half the cores
+# for intra-op work leaves room for FastAPI's threadpool; with several uvicorn
+# workers, lower LLM_VIZ_THREADS so workers x threads <= cores.
+NUM_THREADS = int(os.getenv("LLM_VIZ_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(NUM_THREADS))
+os.environ.setdefault("MKL_DYNAMIC", "FALSE")
+
+from cachetools import LRUCache
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware  # ✅ CORS
-from pydantic import BaseModel
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+from transformers.pytorch_utils import Conv1D
 import torch
-
-from sklearn.decomposition import PCA
 import numpy as np
-from transformer_lens import HookedTransformer
+import orjson
+
+torch.set_num_threads(NUM_THREADS)
+try:
+    torch.set_num_interop_threads(2)
+except RuntimeError as e:
+    # Allowed once per process, before any inter-op work (e.g. on re-import)
+    print("Inter-op thread count not set:", e)
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(app):
+    """Create the inference semaphore and /next_token batcher on the server's event loop"""
+    # On Python 3.9 asyncio primitives bind to the loop current at construction,
+    # so they can't be created at import time
+    global _inference_slots, _next_token_queue
+    _inference_slots = asyncio.Semaphore(N_PARALLEL)
+    _next_token_queue = asyncio.Queue()
+    batcher = asyncio.create_task(_next_token_batcher())
+    try:
+        yield
+    finally:
+        batcher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await batcher
 
 
-app = FastAPI(title="LLM Visualization API", version="1.0.0")
+# orjson serializes NumPy arrays straight from their buffers (OPT_SERIALIZE_NUMPY),
+# avoiding millions of boxed Python floats for attention/hidden-state tensors.
+# Handlers whose payload holds NumPy arrays must return ORJSONResponse(...)
+# themselves: a returned dict goes through jsonable_encoder first, which rejects
+# ndarrays.
+app = FastAPI(title="LLM Visualization API", version="1.0.0", default_response_class=ORJSONResponse, lifespan=_lifespan)
 
 # ✅ Allow frontend (React @ localhost:5173) to make API calls
 app.add_middleware(
@@ -30,13 +80,70 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Shape", "X-Dtype"],  # shape/dtype of /attention_bin payloads
 )
 
+# Server-Sent Event endpoints are never compressed: gzip/brotli buffer output
+# until a block fills, so events would stop reaching the client one by one
+# (older Starlette GZipMiddleware compresses text/event-stream too).
+UNCOMPRESSED_PATHS = frozenset({"/generate_stream"})
+
+
+class _SelectiveCompression:
+    """Apply a compression middleware to every HTTP path except UNCOMPRESSED_PATHS"""
+
+    def __init__(self, app, compression, **options):
+        self.app = app
+        self.compressed = compression(app, **options)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in UNCOMPRESSED_PATHS:
+            await self.app(scope, receive, send)
+        else:
+            await self.compressed(scope, receive, send)
+
+
+# Compress large responses; attention/hidden-state JSON shrinks ~5-10x. Brotli
+# (better ratio at similar CPU) is used when brotli-asgi is installed, falling
+# back to gzip for clients that don't accept br.
+try:
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(
+        _SelectiveCompression, compression=BrotliMiddleware, quality=5, minimum_size=2048, gzip_fallback=True
+    )
+except ImportError:
+    app.add_middleware(_SelectiveCompression, compression=GZipMiddleware, minimum_size=2048, compresslevel=5)
+
+
+# Weight/activation dtype for both models. BF16 halves memory traffic and runs on
+# AVX-512-BF16/AMX CPUs at up to twice FP32 throughput; use "float32" on older CPUs.
+# "int8" dynamically quantizes GPT-2's linear layers (int8 weights, FP32
+# activations, oneDNN VNNI kernels on x86); TransformerLens then runs in FP32.
+DTYPE_NAME = os.getenv("LLM_VIZ_DTYPE", "bfloat16")
+QUANTIZE_INT8 = DTYPE_NAME == "int8"
+MODEL_DTYPE = torch.float32 if QUANTIZE_INT8 else getattr(torch, DTYPE_NAME)
+
+# Optionally compile the GPT-2 forward to fuse elementwise ops and drop per-block
+# Python overhead. Off by default: startup grows by the warmup compiles below, and
+# any shape those don't cover still recompiles inside a request.
+TORCH_COMPILE = os.getenv("LLM_VIZ_COMPILE", "0") == "1"
+
+# The full analysis forward (hidden states + attentions) is traced once per length
+# bucket; inputs are right-padded to the nearest bucket so every call hits a graph
+# with a static shape. Longer inputs fall back to the regular model.
+JIT_TRACE = os.getenv("LLM_VIZ_JIT_TRACE", "1") == "1"
+TRACE_BUCKETS = (16, 32, 64, 128, 256, 512)
 
 # Load tokenizer and model (GPT-2)
 try:
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-    model = GPT2LMHeadModel.from_pretrained("gpt2", output_hidden_states=True, output_attentions=True)
+    # Rust-backed tokenizer; BPE is an order of magnitude faster than GPT2Tokenizer
+    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
+    # Eager attention: the SDPA kernels never materialize attention weights, so
+    # output_attentions would come back as a tuple of None
+    model = GPT2LMHeadModel.from_pretrained(
+        "gpt2", output_hidden_states=True, output_attentions=True, attn_implementation="eager"
+    )
+    model.to(MODEL_DTYPE)
     model.eval()
     # GPT-2 tokenizer doesn't have a pad token by default
     if tokenizer.pad_token is None:
@@ -46,18 +153,606 @@ except Exception as e:
     tokenizer = None
     model = None
 
-# Load TransformerLens model for residual stream
-try:
-    tl_model = HookedTransformer.from_pretrained("gpt2-small", device="cpu")
-except Exception as e:
-    print("TransformerLens load error:", e)
-    tl_model = None
+
+def _conv1d_to_linear(module: torch.nn.Module) -> None:
+    """
+    Replace transformers' Conv1D layers with equivalent nn.Linear layers in place
+
+    GPT-2 implements its attention and MLP projections as Conv1D (a transposed
+    linear), which quantize_dynamic doesn't recognize.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            in_features, out_features = child.weight.shape
+            linear = torch.nn.Linear(in_features, out_features)
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+
+
+if model is not None and QUANTIZE_INT8:
+    try:
+        _conv1d_to_linear(model)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    except Exception as e:
+        # The Conv1D -> Linear swap is numerically identical, so FP32 still works
+        print("Quantization error, running in FP32:", e)
+
+
+class _AnalysisForward(torch.nn.Module):
+    """GPT-2 forward returning plain tensor tuples, so it can be traced with torch.jit.trace"""
+
+    def __init__(self, lm: GPT2LMHeadModel):
+        super().__init__()
+        self.lm = lm
+
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        outputs = self.lm(
+            input_ids,
+            attention_mask=attention_mask,
+            use_cache=False,
+            output_hidden_states=True,
+            output_attentions=True,
+        )
+        return outputs.logits, outputs.hidden_states, outputs.attentions
+
+
+def _no_extra_mask(length: int) -> torch.Tensor:
+    """
+    All-zero additive 4D attention mask for an unpadded batch of one
+
+    A ready-made 4D mask is used as-is (transformers >= 4.52), skipping the
+    causal-mask builder (its torch.vmap can't be traced). Eager GPT-2 attention
+    applies the causal mask itself, so nothing else needs masking.
+    """
+    return torch.zeros((1, 1, 1, length), dtype=MODEL_DTYPE)
+
+
+_traced = {}  # bucket length -> traced _AnalysisForward
+if model is not None and JIT_TRACE:
+    try:
+        analysis_forward = _AnalysisForward(model).eval()
+        with torch.no_grad():
+            for bucket in TRACE_BUCKETS:
+                example = torch.full((1, bucket), tokenizer.eos_token_id, dtype=torch.long)
+                _traced[bucket] = torch.jit.trace(
+                    analysis_forward, (example, _no_extra_mask(bucket)), check_trace=False
+                )
+            # Transformers versions that read the 4D mask differently would trace
+            # fine but attend wrongly; compare against the eager model once
+            probe = torch.arange(3).unsqueeze(0)
+            padded = torch.nn.functional.pad(probe, (0, TRACE_BUCKETS[0] - 3), value=tokenizer.eos_token_id)
+            traced_attention = _traced[TRACE_BUCKETS[0]](padded, _no_extra_mask(TRACE_BUCKETS[0]))[2][0]
+            eager_attention = model(probe, output_attentions=True).attentions[0]
+            if not torch.allclose(traced_attention[:, :, :3, :3].float(), eager_attention.float(), atol=1e-2, rtol=0):
+                raise RuntimeError("traced attention does not match the eager model")
+    except Exception as e:
+        print("torch.jit.trace error, falling back to eager:", e)
+        _traced = {}
+
+if model is not None and TORCH_COMPILE:
+    try:
+        # dynamic=True compiles symbolic sequence lengths instead of one graph per length
+        model = torch.compile(model, dynamic=True)
+        # Warm up the call patterns the endpoints use (full analysis, prefill,
+        # decode/extension on a legacy-tuple KV cache, padded batch) with fresh
+        # contiguous tensors, matching what requests pass in
+        def _warmup_ids(batch: int, length: int) -> torch.Tensor:
+            return torch.full((batch, length), tokenizer.eos_token_id, dtype=torch.long)
+
+        # _tokenize output is created outside inference_mode, like real analysis inputs
+        analysis_inputs = dict(tokenizer("warmup analysis input", return_tensors="pt"))
+        with torch.inference_mode():
+            model(**analysis_inputs)
+            flags = dict(use_cache=True, output_hidden_states=False, output_attentions=False)
+            for prefix_len, new_len in ((4, 1), (5, 3), (6, 2)):
+                past = model(_warmup_ids(1, prefix_len), past_key_values=None, **flags).past_key_values
+                past = getattr(past, "to_legacy_cache", lambda: past)()
+                # Straight from the model (/generate_stream steps), then contiguous
+                # as stored in PREFIX_KV
+                step_past = model(_warmup_ids(1, 1), past_key_values=past, **flags).past_key_values
+                step_past = getattr(step_past, "to_legacy_cache", lambda: step_past)()
+                model(_warmup_ids(1, 1), past_key_values=step_past, **flags)
+                past = tuple((k.contiguous(), v.contiguous()) for k, v in past)
+                model(_warmup_ids(1, new_len), past_key_values=past, **flags)
+            for batch in (2, 3):
+                model(_warmup_ids(batch, 8), attention_mask=torch.ones((batch, 8), dtype=torch.long), **flags)
+    except Exception as e:
+        print("torch.compile error, falling back to eager:", e)
+        model = getattr(model, "_orig_mod", model)
+
+
+@cache
+def _load_tl_model():
+    """Load the TransformerLens model for residual stream (None if loading fails)"""
+    try:
+        from transformer_lens import HookedTransformer
+        return HookedTransformer.from_pretrained("gpt2-small", device="cpu", dtype=MODEL_DTYPE)
+    except Exception as e:
+        print("TransformerLens load error:", e)
+        return None
+
+
+_tl_model_lock = threading.Lock()
+
+
+def _get_tl_model():
+    """
+    TransformerLens model, loaded on first use
+
+    Only /residual_stream needs it, so deferring the import and the second copy
+    of GPT-2 keeps startup time and memory down for everything else. The lock
+    stops concurrent first requests from loading it twice.
+    """
+    with _tl_model_lock:
+        return _load_tl_model()
+
+
+@lru_cache(maxsize=1024)
+def _tokenize(text: str) -> Mapping[str, torch.Tensor]:
+    """
+    Tokenize text once and share the result across endpoints
+
+    The returned mapping is read-only and its tensors must not be modified
+    in place, since the same objects are handed to every caller.
+    """
+    inputs: Dict[str, torch.Tensor] = dict(tokenizer(text, return_tensors="pt", add_special_tokens=True))
+    return MappingProxyType(inputs)
+
+
+# Prefix KV cache for /next_token: maps a token-id prefix to the past_key_values
+# GPT-2 produced for it, so extending a prompt only runs the new tokens.
+# Each cached token costs ~72 KB in FP32 (12 layers x K/V x 768 floats) and every
+# entry holds its whole prefix, so the bound is on the total tokens stored.
+PREFIX_KV_MAX_TOKENS = int(os.getenv("LLM_VIZ_PREFIX_KV_TOKENS", "4096"))
+PREFIX_KV: "OrderedDict[Tuple[int, ...], Tuple[Tuple[torch.Tensor, torch.Tensor], ...]]" = OrderedDict()
+_prefix_kv_lock = threading.Lock()  # batches run in N_PARALLEL worker threads at once
+
+
+def _lookup_prefix_kv(input_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+    """
+    Find the longest cached proper prefix of input_ids
+
+    At least one token is always left uncached so the model still produces
+    logits for the final position.
+
+    Returns:
+        tuple: (prefix_len, past_key_values), or (0, None) on a miss
+    """
+    ids = tuple(input_ids)
+    with _prefix_kv_lock:
+        # Scanning the keys costs at most PREFIX_KV_MAX_TOKENS comparisons, unlike
+        # hashing every candidate prefix of input_ids
+        best = max(
+            (key for key in PREFIX_KV if len(key) < len(ids) and ids[:len(key)] == key),
+            key=len,
+            default=None,
+        )
+        if best is None:
+            return 0, None
+        PREFIX_KV.move_to_end(best)
+        return len(best), PREFIX_KV[best]
+
+
+def _legacy_kv(past_key_values):
+    """
+    Convert a transformers Cache object to the legacy ((key, value), ...) tuple
+
+    Cache objects are extended in place when passed back to the model, so only
+    the legacy tuple form is safe to share. If the installed transformers can't
+    produce it, the Cache is returned unchanged and must stay private to the caller.
+    """
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _store_prefix_kv(input_ids: List[int], past_key_values) -> None:
+    """Insert past_key_values for input_ids, evicting the least recently used entries"""
+    past_key_values = _legacy_kv(past_key_values)
+    if not isinstance(past_key_values, tuple):
+        # A mutable Cache would be corrupted by the next prefix hit; don't share it
+        return
+    # One memory layout (and inference-tensor kind) for every entry, which also
+    # keeps torch.compile guards stable
+    with torch.inference_mode():
+        past_key_values = tuple((k.contiguous(), v.contiguous()) for k, v in past_key_values)
+    key = tuple(input_ids)
+    if len(key) > PREFIX_KV_MAX_TOKENS:
+        return
+    with _prefix_kv_lock:
+        PREFIX_KV[key] = past_key_values
+        PREFIX_KV.move_to_end(key)
+        cached_tokens = sum(map(len, PREFIX_KV))
+        while cached_tokens > PREFIX_KV_MAX_TOKENS:
+            evicted, _ = PREFIX_KV.popitem(last=False)
+            cached_tokens -= len(evicted)
+
+
+# Bound on concurrent forward passes; torch already parallelizes each one internally,
+# so letting every request in at once only thrashes the CPU.
+N_PARALLEL = int(os.getenv("LLM_VIZ_PARALLEL", "2"))
+_inference_slots: Optional[asyncio.Semaphore] = None  # created by _lifespan
+
+
+async def _run_inference(fn, *args, **kwargs):
+    """Run a blocking torch call in the threadpool, bounded by N_PARALLEL"""
+    async with _inference_slots:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+class ModelRun(NamedTuple):
+    """Per-layer tensors from one full GPT-2 forward pass"""
+    hidden_states: Tuple[torch.Tensor, ...]
+    attentions: Tuple[torch.Tensor, ...]
+    next_token_logits: torch.Tensor  # FP32 logits for the position after the text
+
+
+def _forward(inputs) -> ModelRun:
+    """Full GPT-2 forward pass (hidden states + attentions) for tokenized inputs"""
+    input_ids = inputs["input_ids"]
+    seq_len = input_ids.shape[1]
+    bucket = next((b for b in TRACE_BUCKETS if b >= seq_len > 0 and b in _traced), None)
+    with torch.inference_mode():
+        if bucket is None:
+            outputs = model(**inputs)
+            return ModelRun(
+                hidden_states=outputs.hidden_states or (),
+                attentions=outputs.attentions or (),
+                next_token_logits=outputs.logits[0, -1, :].to(torch.float32, copy=True),
+            )
+        padded = torch.nn.functional.pad(input_ids, (0, bucket - seq_len), value=tokenizer.eos_token_id)
+        logits, hidden_states, attentions = _traced[bucket](padded, _no_extra_mask(bucket))
+    # Under causal attention the right padding never affects the real positions,
+    # so slicing it off gives exactly the unpadded result. Every slice is
+    # copied: a view would keep the whole padded tensor alive in the cache
+    return ModelRun(
+        hidden_states=tuple(h[:, :seq_len].clone() for h in hidden_states),
+        attentions=tuple(a[:, :, :seq_len, :seq_len].clone() for a in attentions),
+        next_token_logits=logits[0, seq_len - 1, :].to(torch.float32, copy=True),
+    )
+
+
+def _nbytes(value) -> int:
+    """Tensor bytes held by a ModelRun (or a single tensor), for byte-bounded caches"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    return sum(_nbytes(item) for item in value)
+
+
+# Forward outputs (and their PCA projection) cached by input text, so the
+# visualization endpoints share one forward pass and repeated UI requests for
+# the same text skip the model. The bound is in bytes: attentions grow with the
+# square of the length, from ~5 MB for 100 tokens to ~300 MB for 1024 in BF16.
+# Runs larger than the whole budget are simply not cached.
+MODEL_OUTPUT_CACHE_BYTES = int(float(os.getenv("LLM_VIZ_OUTPUT_CACHE_MB", "512")) * 2**20)
+_model_runs: LRUCache = LRUCache(maxsize=MODEL_OUTPUT_CACHE_BYTES, getsizeof=_nbytes)
+# PCA projections are [seq_len, 3] FP32, a few KB each
+_embeddings3d: LRUCache = LRUCache(maxsize=MODEL_OUTPUT_CACHE_BYTES, getsizeof=_nbytes)
+_output_cache_lock = threading.Lock()  # cachetools caches aren't thread-safe
+
+
+def _cache_put(cache: LRUCache, key: bytes, value) -> None:
+    """Insert into a byte-bounded output cache, skipping values larger than its whole budget"""
+    if cache.getsizeof(value) <= cache.maxsize:
+        with _output_cache_lock:
+            cache[key] = value
+
+
+def _text_key(text: str) -> bytes:
+    """Compact fixed-size cache key for arbitrarily long input text"""
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+def _run_model(text: str) -> ModelRun:
+    """Hidden states and attentions for text, served from the LRU cache when possible"""
+    key = _text_key(text)
+    with _output_cache_lock:
+        cached = _model_runs.get(key)
+    if cached is not None:
+        return cached
+    run = _forward(_tokenize(text))
+    _cache_put(_model_runs, key, run)
+    return run
+
+
+def _pca_3d(text: str, last_hidden: torch.Tensor) -> List[List[float]]:
+    """3D PCA projection of the last hidden state, cached alongside the model run"""
+    key = _text_key(text)
+    with _output_cache_lock:
+        cached = _embeddings3d.get(key)
+    if cached is not None:
+        return cached.tolist()
+    last_hidden = last_hidden.squeeze(0).float()  # [seq_len, hidden_dim]
+    if min(last_hidden.shape) < 3:
+        return []
+    # Randomized FP32 SVD on the tensor itself; far cheaper than a full FP64 SVD.
+    # Oversampling to 8 components (plus extra power iterations) keeps the top 3
+    # close to the exact ones, and a fixed seed makes every worker return the
+    # same projection for the same text
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(0)
+        _, _, V = torch.pca_lowrank(last_hidden, q=min(8, *last_hidden.shape), center=True, niter=4)
+    embeddings3d = (last_hidden - last_hidden.mean(dim=0)) @ V[:, :3]
+    # Kept as a tensor so the cache can size it; lists are built per response
+    _cache_put(_embeddings3d, key, embeddings3d)
+    return embeddings3d.tolist()
+
+
+def _run_with_cache(tl_model, input_ids: torch.Tensor):
+    """TransformerLens forward pass recording every hook activation"""
+    with torch.inference_mode():
+        return tl_model.run_with_cache(input_ids)
+
+
+def _decode_step(new_ids: List[int], past_key_values=None):
+    """
+    Run new_ids through GPT-2 on top of past_key_values
+    
+    Returns:
+        tuple: (FP32 logits for the next token, updated legacy past_key_values)
+    """
+    with torch.inference_mode():
+        outputs = model(
+            torch.tensor([new_ids]),
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_hidden_states=False,
+            output_attentions=False,
+        )
+    # Softmax/top-k run in FP32 regardless of MODEL_DTYPE
+    return outputs.logits[0, -1, :].to(torch.float32, copy=True), _legacy_kv(outputs.past_key_values)
+
+
+def _prefill(input_ids: List[int], hit: Optional[Tuple[int, Optional[tuple]]] = None) -> Tuple[torch.Tensor, tuple]:
+    """
+    Run input_ids through GPT-2, reusing (and extending) the prefix KV cache
+    
+    Args:
+        input_ids: Prompt token ids
+        hit: Result of a _lookup_prefix_kv(input_ids) the caller already made
+    
+    Returns:
+        tuple: (FP32 logits for the next token, legacy past_key_values for input_ids)
+    """
+    prefix_len, past_key_values = hit if hit is not None else _lookup_prefix_kv(input_ids)
+    # Only the tokens not covered by the cache are run through the model
+    logits, past_key_values = _decode_step(input_ids[prefix_len:], past_key_values)
+    _store_prefix_kv(input_ids, past_key_values)
+    return logits, past_key_values
+
+
+def _next_token_logits(input_ids: List[int]) -> torch.Tensor:
+    """Logits for the token following input_ids, reusing the prefix KV cache"""
+    return _prefill(input_ids)[0]
+
+
+def _try_next_token_logits(input_ids: List[int], hit: Optional[Tuple[int, Optional[tuple]]] = None):
+    """_prefill's logits for one prompt, or the exception it raised"""
+    try:
+        return _prefill(input_ids, hit)[0]
+    except Exception as e:
+        return e
+
+
+def _next_token_logits_batch(batch_ids: List[List[int]]) -> List[Union[torch.Tensor, Exception]]:
+    """
+    Next-token logits for several prompts at once
+
+    Prompts with a cached prefix only need a few new tokens and are run on
+    their own; the remaining prompts are right-padded into a single forward
+    pass. Right padding keeps the valid positions exact under causal attention,
+    so per-row logits and KV caches can be sliced straight out of the batch.
+
+    Returns:
+        list: Per prompt, its FP32 logits or the exception it failed with, so
+        one bad prompt doesn't fail the others
+    """
+    results: List[Optional[Union[torch.Tensor, Exception]]] = [None] * len(batch_ids)
+    misses = []
+    for i, input_ids in enumerate(batch_ids):
+        hit = _lookup_prefix_kv(input_ids)
+        if len(batch_ids) == 1 or hit[1] is not None:
+            results[i] = _try_next_token_logits(input_ids, hit)
+        else:
+            misses.append(i)
+
+    if misses:
+        lengths = [len(batch_ids[i]) for i in misses]
+        try:
+            with torch.inference_mode():
+                # GPT-2 pads on the right; a multiple of 8 keeps matmul shapes SIMD/tile friendly
+                padded = tokenizer.pad(
+                    {"input_ids": [batch_ids[i] for i in misses]},
+                    padding=True,
+                    pad_to_multiple_of=8,
+                    return_tensors="pt",
+                )
+                outputs = model(
+                    padded["input_ids"],
+                    attention_mask=padded["attention_mask"],
+                    use_cache=True,
+                    output_hidden_states=False,
+                    output_attentions=False,
+                )
+        except Exception:
+            # Rerun only the misses alone so just the prompt that broke the
+            # padded batch (e.g. one past n_positions) fails
+            for i in misses:
+                results[i] = _try_next_token_logits(batch_ids[i])
+            return results
+        past_key_values = _legacy_kv(outputs.past_key_values)
+        # Per-row KV slices need the legacy tuple form; without it the logits
+        # are still returned, the rows just aren't added to the prefix cache
+        can_cache = isinstance(past_key_values, tuple)
+
+        for row, (i, length) in enumerate(zip(misses, lengths)):
+            results[i] = outputs.logits[row, length - 1, :].to(torch.float32, copy=True)
+            if can_cache:
+                _store_prefix_kv(batch_ids[i], tuple(
+                    (k[row:row + 1, :, :length].clone(), v[row:row + 1, :, :length].clone())
+                    for k, v in past_key_values
+                ))
+
+    return results
+
+
+# Dynamic batching for /next_token: requests arriving within MAX_WAIT_MS of each
+# other are coalesced into one forward pass of up to MAX_BATCH_SIZE prompts.
+MAX_BATCH_SIZE = int(os.getenv("LLM_VIZ_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.getenv("LLM_VIZ_MAX_WAIT_MS", "8"))
+_next_token_queue: Optional["asyncio.Queue[Tuple[List[int], asyncio.Future]]"] = None  # created by _lifespan
+_pending_batches = set()  # strong refs so in-flight batch tasks aren't garbage collected
+
+
+async def _dispatch_next_token_batch(batch) -> None:
+    """Run one coalesced batch and resolve each caller's future"""
+    try:
+        results = await _run_inference(_next_token_logits_batch, [ids for ids, _ in batch])
+    except Exception as e:
+        results = [e] * len(batch)
+    for (_, fut), result in zip(batch, results):
+        if fut.done():
+            continue
+        if isinstance(result, Exception):
+            fut.set_exception(result)
+        else:
+            fut.set_result(result)
+
+
+async def _next_token_batcher() -> None:
+    """Background task draining the /next_token queue into micro-batches"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _next_token_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_next_token_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Batches run concurrently (bounded by N_PARALLEL) while the next one fills
+        task = asyncio.create_task(_dispatch_next_token_batch(batch))
+        _pending_batches.add(task)
+        task.add_done_callback(_pending_batches.discard)
+
+
+async def _queue_next_token(input_ids: List[int]) -> torch.Tensor:
+    """Submit a prompt to the batcher and wait for its next-token logits"""
+    fut = asyncio.get_running_loop().create_future()
+    await _next_token_queue.put((input_ids, fut))
+    return await fut
+
+
+def _to_wire(tensor: torch.Tensor) -> np.ndarray:
+    """Contiguous FP16 NumPy copy of a tensor, to be sent in an ORJSONResponse"""
+    return np.ascontiguousarray(tensor.to(torch.float16).numpy())
+
+
+def _format_next_token(next_token_logits: torch.Tensor) -> dict:
+    """
+    Top-10 next-token prediction in the /next_token response format
+    
+    Probabilities are a softmax over the top 10 logits only, i.e. renormalized
+    over the returned candidates (matching the frontend's softmax animation)
+    rather than over the full 50257-token vocabulary.
+    """
+    # Get top 10 logits and their token ids
+    top_logits_t, top_indices = torch.topk(next_token_logits, k=10, dim=-1)
+    
+    # Apply softmax over the survivors to get probabilities
+    top_probs = torch.softmax(top_logits_t, dim=-1)
+    
+    # Convert to list and get tokens for each probability (one .tolist() and a
+    # single batched decode instead of a decode/.item() per candidate)
+    top_probs_list = top_probs.tolist()
+    top_ids = top_indices.tolist()
+    top_tokens = tokenizer.batch_decode([[token_id] for token_id in top_ids], skip_special_tokens=False)
+    
+    # Raw logits for the top 10 tokens (for softmax animation)
+    top_logits = top_logits_t.tolist()
+    
+    # Format probabilities for frontend
+    probs_list = [{"token": token.strip(), "prob": prob, "logit": logit} for token, prob, logit in zip(top_tokens, top_probs_list, top_logits)]
+    
+    # Get the top token (highest probability)
+    return {
+        "token": top_tokens[0].strip(),
+        "token_id": top_ids[0],
+        "probability": top_probs_list[0],
+        "probs": probs_list
+    }
+
+
+ANALYZE_FIELDS = frozenset({"attentions", "hidden_states", "embeddings3d", "next_token"})
+
+
+def _analysis_fields(text: str, fields=ANALYZE_FIELDS) -> dict:
+    """
+    Run GPT-2 once for text and build the requested response fields
+    
+    Args:
+        text: Input text to analyze
+        fields: Subset of ANALYZE_FIELDS to include in the result
+        
+    Returns:
+        dict: num_layers plus one entry per requested field, ready to serialize
+    """
+    run = _run_model(text)
+    result = {"num_layers": len(run.attentions)}
+    if "attentions" in fields:
+        result["attentions"] = [_to_wire(layer.squeeze(0)) for layer in run.attentions]
+    if "hidden_states" in fields:
+        result["hidden_states"] = [_to_wire(layer.squeeze(0)) for layer in run.hidden_states]
+    if "embeddings3d" in fields:
+        # embeddings3d: PCA of last hidden state (for visualization)
+        embeddings3d = []
+        if run.hidden_states and run.hidden_states[-1].shape[1] > 0:
+            try:
+                embeddings3d = _pca_3d(text, run.hidden_states[-1])
+            except Exception as e:
+                print("PCA error:", e)
+                embeddings3d = []
+        result["embeddings3d"] = embeddings3d
+    if "next_token" in fields:
+        result["next_token"] = _format_next_token(run.next_token_logits)
+    return result
+
+
+async def _analyze(text: str, fields=ANALYZE_FIELDS) -> dict:
+    """
+    _analysis_fields on the threadpool
+
+    The FP16 wire conversion copies every attention and hidden-state layer
+    (tens of millions of elements for long inputs), so it runs with the
+    forward pass instead of on the event loop.
+    """
+    return await _run_inference(_analysis_fields, text, fields)
+
+
+# GPT-2's byte-level BPE renders a leading space as "Ġ"
+_BYTE_SPACE_TABLE = str.maketrans({"Ġ": " "})
 
 
 class TextInput(BaseModel):
     """Request model for text input endpoints"""
     text: str
 
+class AnalyzeInput(BaseModel):
+    """Request model for the combined /analyze endpoint"""
+    text: str
+    include_next_token: bool = True
+
+class GenerateInput(BaseModel):
+    """Request model for streaming generation"""
+    text: str
+    max_new_tokens: int = Field(20, ge=1)
+
 class EmbeddingInput(BaseModel):
     """Request model for embedding endpoints with layer specification"""
     text: str
@@ -65,7 +760,7 @@ class EmbeddingInput(BaseModel):
 
 
 @app.post("/tokenize")
-def tokenize_text(input: TextInput):
+async def tokenize_text(input: TextInput):
     """
     Tokenize input text using GPT-2 tokenizer
     
@@ -73,31 +768,19 @@ def tokenize_text(input: TextInput):
         input: TextInput object containing text to tokenize
         
     Returns:
-        dict: Contains input_ids, cleaned tokens, and attention_mask
+        dict: Contains input_ids, cleaned tokens (one per input id), and attention_mask
     """
     if tokenizer is None:
         print("/tokenize error: tokenizer not loaded")
         return {"input_ids": [], "tokens": [], "attention_mask": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        raw_tokens = tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
+        inputs = _tokenize(input.text)
         input_ids = inputs["input_ids"][0].tolist()
+        raw_tokens = tokenizer.convert_ids_to_tokens(input_ids)
         
-        # Clean up tokens for better display and remove duplicates
-        cleaned_tokens = []
-        seen_tokens = set()
-        
-        for token in raw_tokens:
-            # Clean the token
-            if token.startswith('Ġ'):
-                clean_token = ' ' + token[1:]
-            else:
-                clean_token = token
-            
-            # Only add if we haven't seen this exact token before
-            if clean_token not in seen_tokens:
-                cleaned_tokens.append(clean_token)
-                seen_tokens.add(clean_token)
+        # Clean up tokens for better display. Repeated tokens are kept so that
+        # tokens stay aligned with input_ids and the attention matrices.
+        cleaned_tokens = [token.translate(_BYTE_SPACE_TABLE) for token in raw_tokens]
         
         return {
             "input_ids": input_ids,
@@ -109,7 +792,7 @@ def tokenize_text(input: TextInput):
         return {"input_ids": [], "tokens": [], "attention_mask": []}
 
 @app.post("/next_token")
-def next_token_prediction(input: TextInput):
+async def next_token_prediction(input: TextInput):
     """
     Predict next token using GPT-2 model
     
@@ -124,52 +807,86 @@ def next_token_prediction(input: TextInput):
         return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
     try:
         # Tokenize input text
-        inputs = tokenizer.encode(input.text, return_tensors="pt")
+        input_ids = _tokenize(input.text)["input_ids"][0].tolist()
+        if not input_ids:
+            return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
+        # GPT-2 has no position embedding past n_positions; reject before batching
+        if len(input_ids) > model.config.n_positions:
+            print(f"/next_token error: prompt exceeds {model.config.n_positions} tokens")
+            return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
         
-        with torch.no_grad():
-            # Get model outputs
-            outputs = model(inputs)
-            logits = outputs.logits
-            
-            # Get the logits for the last token (next token prediction)
-            next_token_logits = logits[0, -1, :]
-            
-            # Apply softmax to get probabilities
-            probs = torch.softmax(next_token_logits, dim=-1)
-            
-            # Get top 10 probabilities and their corresponding tokens
-            top_probs, top_indices = torch.topk(probs, k=10, dim=-1)
-            
-            # Convert to list and get tokens for each probability
-            top_probs_list = top_probs.tolist()
-            top_tokens = [tokenizer.decode([idx.item()]) for idx in top_indices]
-            
-            # Get raw logits for the top 10 tokens (for softmax animation)
-            top_logits = next_token_logits[top_indices].tolist()
-            
-            # Format probabilities for frontend
-            probs_list = [{"token": token.strip(), "prob": prob, "logit": logit} for token, prob, logit in zip(top_tokens, top_probs_list, top_logits)]
-            
-            # Get the top token (highest probability)
-            token = top_tokens[0].strip()
-            token_id = top_indices[0].item()
-            probability = top_probs_list[0]
-            
-        return {
-            "token": token,
-            "token_id": token_id,
-            "probability": probability,
-            "probs": probs_list
-        }
+        # Get the logits for the last token (next token prediction); the
+        # batcher coalesces concurrent callers and reuses cached prefixes
+        next_token_logits = await _queue_next_token(input_ids)
+        return _format_next_token(next_token_logits)
     except Exception as e:
         print("/next_token error:", e)
         return {"token": "", "token_id": -1, "probability": 0.0, "probs": []}
 
 
 
+# Upper bound on tokens generated per /generate_stream request
+MAX_NEW_TOKENS = 256
+
+
+@app.post("/generate_stream")
+async def generate_stream(input: GenerateInput):
+    """
+    Greedily generate tokens and stream them as Server-Sent Events
+    
+    The prompt is prefilled once (reusing the prefix KV cache) and each new
+    token is then a single-token forward pass on the growing KV cache.
+    
+    Args:
+        input: GenerateInput object containing the prompt and max_new_tokens
+        
+    Returns:
+        StreamingResponse: text/event-stream with one event per generated token,
+        each in the /next_token response format plus the decoded generated text so far
+    """
+    async def event_gen():
+        if tokenizer is None or model is None:
+            print("/generate_stream error: model/tokenizer not loaded")
+            return
+        try:
+            input_ids = _tokenize(input.text)["input_ids"][0].tolist()
+            if not input_ids:
+                return
+            # Every generated token but the last is fed back, so the prompt plus
+            # all but one generated token must fit GPT-2's n_positions
+            remaining = model.config.n_positions - len(input_ids) + 1
+            if remaining <= 0:
+                print(f"/generate_stream error: prompt exceeds {model.config.n_positions} tokens")
+                return
+            num_tokens = min(input.max_new_tokens, MAX_NEW_TOKENS, remaining)
+            
+            # Prefill: only the tokens not covered by the prefix KV cache. The
+            # cache lookup/store stays on the worker thread with the forward pass
+            logits, past_key_values = await _run_inference(_prefill, input_ids)
+            
+            generated_ids: List[int] = []
+            for step in range(num_tokens):
+                prediction = _format_next_token(logits)
+                generated_ids.append(prediction["token_id"])
+                # "token" is stripped for display; decoding the whole continuation
+                # keeps spacing and multi-byte characters split across tokens intact
+                prediction["text"] = tokenizer.decode(generated_ids)
+                yield f"data: {orjson.dumps(prediction).decode()}\n\n"
+                if prediction["token_id"] == tokenizer.eos_token_id or step == num_tokens - 1:
+                    break
+                logits, past_key_values = await _run_inference(_decode_step, [prediction["token_id"]], past_key_values)
+        except Exception as e:
+            print("/generate_stream error:", e)
+    
+    return StreamingResponse(event_gen(), media_type="text/event-stream")
+
+
 @app.post("/residual_stream")
-def get_residual_stream(input: TextInput):
+async def get_residual_stream(input: TextInput):
     """Get residual stream norms using TransformerLens"""
+    # The first call downloads and loads the model; that needn't hold an
+    # inference slot, only the forward pass below does
+    tl_model = await asyncio.to_thread(_get_tl_model)
     if tl_model is None:
         return {"layer_values": [], "tokens": [], "num_layers": 0}
     try:
@@ -178,19 +895,16 @@ def get_residual_stream(input: TextInput):
         input_ids = tl_model.to_tokens(input.text)
 
         # 2. Run model with cache
-        _, cache = tl_model.run_with_cache(input_ids)
+        _, cache = await _run_inference(_run_with_cache, tl_model, input_ids)
 
-        # 3. Extract residual norms
-        layer_values = []
+        # 3. Extract residual norms for every token/layer in one vectorized call
         num_layers = tl_model.cfg.n_layers
-
-        for token_idx in range(input_ids.shape[1]):
-            token_vals = []
-            for layer in range(num_layers + 1):  # +1 for embedding layer
-                resid_key = f"blocks.{layer}.hook_resid_post" if layer < num_layers else "hook_embed"
-                resid = cache[resid_key][0, token_idx]
-                token_vals.append(torch.norm(resid).item())
-            layer_values.append(token_vals)
+        resid = torch.stack([
+            cache[f"blocks.{layer}.hook_resid_post"] if layer < num_layers else cache["hook_embed"]
+            for layer in range(num_layers + 1)  # +1 for embedding layer
+        ])  # [num_layers + 1, 1, seq_len, d_model]
+        norms = resid[:, 0].float().norm(dim=-1).transpose(0, 1)  # [seq_len, num_layers + 1]
+        layer_values = norms.tolist()
 
         # 4. Clean tokens (remove special tokens)
         clean_tokens = []
@@ -211,7 +925,7 @@ def get_residual_stream(input: TextInput):
 
 
 @app.post("/attention")
-def get_attention(input: TextInput):
+async def get_attention(input: TextInput):
     """
     Extract attention weights from GPT-2 model
     
@@ -225,21 +939,49 @@ def get_attention(input: TextInput):
         print("/attention error: model/tokenizer not loaded")
         return {"num_layers": 0, "attentions": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        attentions = outputs.attentions if hasattr(outputs, 'attentions') else []
-        attentions_data = [layer.squeeze(0).tolist() for layer in attentions] if attentions else []
-        return {
+        attentions_data = (await _analyze(input.text, {"attentions"}))["attentions"]
+        return ORJSONResponse({
             "num_layers": len(attentions_data),
             "attentions": attentions_data
-        }
+        })
     except Exception as e:
         print("/attention error:", e)
         return {"num_layers": 0, "attentions": []}
 
+def _attention_bytes(text: str) -> Tuple[Tuple[int, ...], bytes]:
+    """Attention weights for text as one contiguous little-endian FP16 buffer"""
+    attentions = _run_model(text).attentions
+    stacked = torch.stack(attentions).squeeze(1)  # [num_layers, num_heads, seq_len, seq_len]
+    return tuple(stacked.shape), _to_wire(stacked).astype("<f2", copy=False).tobytes()
+
+
+@app.post("/attention_bin")
+async def get_attention_binary(input: TextInput):
+    """
+    Extract attention weights as raw FP16 bytes instead of JSON
+    
+    Args:
+        input: TextInput object containing text to analyze
+        
+    Returns:
+        Response: application/octet-stream body of little-endian float16 values
+        in [num_layers, num_heads, seq_len, seq_len] order; the shape is sent in
+        the X-Shape header as comma-separated integers
+    """
+    headers = {"X-Shape": "0,0,0,0", "X-Dtype": "float16"}
+    if tokenizer is None or model is None:
+        print("/attention_bin error: model/tokenizer not loaded")
+        return Response(content=b"", media_type="application/octet-stream", headers=headers)
+    try:
+        shape, content = await _run_inference(_attention_bytes, input.text)
+        headers["X-Shape"] = ",".join(str(dim) for dim in shape)
+        return Response(content=content, media_type="application/octet-stream", headers=headers)
+    except Exception as e:
+        print("/attention_bin error:", e)
+        return Response(content=b"", media_type="application/octet-stream", headers=headers)
+
 @app.post("/embeddings")
-def get_embeddings(input: EmbeddingInput):
+async def get_embeddings(input: EmbeddingInput):
     """
     Extract hidden states and return embeddings from a specific layer
     
@@ -254,34 +996,31 @@ def get_embeddings(input: EmbeddingInput):
         return {"embeddings": [], "layer": input.layer}
     
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        
-        hidden_states = outputs.hidden_states if hasattr(outputs, 'hidden_states') else []
+        hidden_states = (await _analyze(input.text, {"hidden_states"}))["hidden_states"]
         
         if not hidden_states:
             return {"embeddings": [], "layer": input.layer}
         
         # Get the specified layer (clamp to valid range)
         layer_idx = max(0, min(input.layer, len(hidden_states) - 1))
-        layer_embeddings = hidden_states[layer_idx].squeeze(0).tolist()  # [seq_len, hidden_dim]
+        layer_embeddings = hidden_states[layer_idx]  # [seq_len, hidden_dim]
+        num_tokens, embedding_dim = layer_embeddings.shape
         
-        print(f"✅ Returning embeddings for layer {layer_idx}, shape: {len(layer_embeddings)} tokens")
+        print(f"✅ Returning embeddings for layer {layer_idx}, shape: {num_tokens} tokens")
         
-        return {
+        return ORJSONResponse({
             "embeddings": layer_embeddings,
             "layer": layer_idx,
-            "num_tokens": len(layer_embeddings),
-            "embedding_dim": len(layer_embeddings[0]) if layer_embeddings else 0
-        }
+            "num_tokens": num_tokens,
+            "embedding_dim": embedding_dim if num_tokens else 0
+        })
         
     except Exception as e:
         print("/embeddings error:", e)
         return {"embeddings": [], "layer": input.layer}
 
 @app.post("/embeddings_all")
-def get_all_embeddings(input: TextInput):
+async def get_all_embeddings(input: TextInput):
     """
     Extract hidden states and compute 3D embeddings using PCA from all layers
     
@@ -295,33 +1034,42 @@ def get_all_embeddings(input: TextInput):
         print("/embeddings_all error: model/tokenizer not loaded")
         return {"num_layers": 0, "hidden_states": [], "embeddings3d": []}
     try:
-        inputs = tokenizer(input.text, return_tensors="pt", add_special_tokens=True)
-        with torch.no_grad():
-            outputs = model(**inputs)
-        hidden_states = outputs.hidden_states if hasattr(outputs, 'hidden_states') else []
-        hidden_states_data = [layer.squeeze(0).tolist() for layer in hidden_states] if hidden_states else []
-        # embeddings3d: PCA of last hidden state (for visualization)
-        embeddings3d = []
-        if hidden_states_data and len(hidden_states_data[-1]) > 0:
-            try:
-                last_hidden = np.array(hidden_states_data[-1])  # [seq_len, hidden_dim]
-                if last_hidden.shape[1] >= 3:
-                    pca = PCA(n_components=3)
-                    embeddings3d = pca.fit_transform(last_hidden).tolist()
-            except Exception as e:
-                print("PCA error:", e)
-                embeddings3d = []
+        result = await _analyze(input.text, {"hidden_states", "embeddings3d"})
+        hidden_states_data = result["hidden_states"]
         # Always return all keys, even if empty
-        return {
+        return ORJSONResponse({
             "num_layers": len(hidden_states_data),
             "hidden_states": hidden_states_data,
-            "embeddings3d": embeddings3d if isinstance(embeddings3d, list) else []
-        }
+            "embeddings3d": result["embeddings3d"]
+        })
     except Exception as e:
         print("/embeddings_all error:", e)
         return {"num_layers": 0, "hidden_states": [], "embeddings3d": []}
 
+@app.post("/analyze")
+async def analyze_text(input: AnalyzeInput):
+    """
+    Run GPT-2 once and return everything the visualization needs
+    
+    Args:
+        input: AnalyzeInput object containing text and whether to predict the next token
+        
+    Returns:
+        dict: Contains num_layers, attentions, hidden_states, embeddings3d and
+        (optionally) next_token in the /next_token response format
+    """
+    empty = {"num_layers": 0, "attentions": [], "hidden_states": [], "embeddings3d": []}
+    if tokenizer is None or model is None:
+        print("/analyze error: model/tokenizer not loaded")
+        return empty
+    try:
+        fields = ANALYZE_FIELDS if input.include_next_token else ANALYZE_FIELDS - {"next_token"}
+        return ORJSONResponse(await _analyze(input.text, fields))
+    except Exception as e:
+        print("/analyze error:", e)
+        return empty
+
 @app.get("/health")
-def health_check():
+async def health_check():
     """Health check endpoint for API status"""
     return {"status": "ok", "model": "gpt2"}
@@ -0,0 +1,288 @@
+"""
+Smoke tests for the FastAPI endpoints
+
+GPT-2 is replaced by a tiny randomly initialised model and a byte-level BPE
+tokenizer trained on the fly, so the tests run offline and in seconds.
+"""
+
+import asyncio
+import importlib
+import os
+import sys
+
+import pytest
+
+orjson = pytest.importorskip("orjson")
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+from tokenizers import ByteLevelBPETokenizer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXT = "The capital of France is Paris. The capital of Italy is"
+
+
+def _stub_tokenizer(*args, **kwargs):
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator([TEXT] * 4, vocab_size=300, special_tokens=["<|endoftext|>"])
+    return transformers.GPT2TokenizerFast(
+        tokenizer_object=bpe._tokenizer,
+        bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>",
+        unk_token="<|endoftext|>",
+    )
+
+
+def _stub_model(*args, **kwargs):
+    config = transformers.GPT2Config(vocab_size=300, n_positions=1024, n_embd=32, n_layer=2, n_head=4, **kwargs)
+    torch.manual_seed(0)
+    return transformers.GPT2LMHeadModel(config)
+
+
+@pytest.fixture(scope="module")
+def app_module():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(transformers.GPT2TokenizerFast, "from_pretrained", _stub_tokenizer)
+        mp.setattr(transformers.GPT2LMHeadModel, "from_pretrained", _stub_model)
+        mp.setenv("LLM_VIZ_DTYPE", "float32")
+        mp.syspath_prepend(BACKEND_DIR)
+        sys.modules.pop("app", None)
+        yield importlib.import_module("app")
+
+
+@pytest.fixture(scope="module")
+def client(app_module):
+    with TestClient(app_module.app) as test_client:
+        yield test_client
+
+
+def _full_forward_logits(app_module, input_ids):
+    with torch.inference_mode():
+        return app_module.model(torch.tensor([input_ids]), use_cache=False).logits[0, -1].float()
+
+
+def test_tokenize(client):
+    data = client.post("/tokenize", json={"text": TEXT}).json()
+    assert len(data["tokens"]) == len(data["input_ids"]) > 0
+
+
+def test_next_token(client):
+    data = client.post("/next_token", json={"text": TEXT}).json()
+    assert data["token_id"] >= 0
+    assert len(data["probs"]) == 10
+
+
+def test_attention(client):
+    response = client.post("/attention", json={"text": TEXT})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["num_layers"] == 2
+    assert len(data["attentions"][0]) == 4  # heads
+
+
+def test_embeddings(client):
+    response = client.post("/embeddings", json={"text": TEXT, "layer": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["layer"] == 1
+    assert data["embedding_dim"] == 32
+    assert len(data["embeddings"]) == data["num_tokens"]
+
+
+def test_embeddings_all(client):
+    response = client.post("/embeddings_all", json={"text": TEXT})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["num_layers"] == 3  # embeddings + 2 blocks
+    assert len(data["embeddings3d"][0]) == 3
+
+
+def test_analyze(client):
+    response = client.post("/analyze", json={"text": TEXT})
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["attentions"]) == 2
+    assert len(data["hidden_states"]) == 3
+    assert data["next_token"]["token_id"] >= 0
+
+
+def test_attention_bin(client):
+    response = client.post("/attention_bin", json={"text": TEXT})
+    assert response.status_code == 200
+    shape = [int(dim) for dim in response.headers["x-shape"].split(",")]
+    assert len(response.content) == 2 * shape[0] * shape[1] * shape[2] * shape[3]
+
+
+def test_generate_stream(client, app_module):
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 3})
+    assert response.status_code == 200
+    events = [orjson.loads(line[len("data: "):]) for line in response.text.split("\n") if line.startswith("data: ")]
+    assert 1 <= len(events) <= 3
+    # "text" is the untouched decoded continuation, unlike the stripped "token"
+    generated_ids = [event["token_id"] for event in events]
+    assert events[-1]["text"] == app_module.tokenizer.decode(generated_ids)
+
+
+def test_generate_stream_rejects_non_positive_max_new_tokens(client):
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 0})
+    assert response.status_code == 422
+
+
+def test_generate_stream_stops_at_n_positions(client, app_module, monkeypatch):
+    num_prompt_tokens = len(app_module._tokenize(TEXT)["input_ids"][0])
+    monkeypatch.setattr(app_module.model.config, "n_positions", num_prompt_tokens + 2)
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 8})
+    assert 1 <= response.text.count("data: ") <= 3  # the last token is never fed back
+    # A prompt filling every position still gets its one predicted token, as in /next_token
+    monkeypatch.setattr(app_module.model.config, "n_positions", num_prompt_tokens)
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 8})
+    assert response.text.count("data: ") == 1
+    monkeypatch.setattr(app_module.model.config, "n_positions", num_prompt_tokens - 1)
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 8})
+    assert response.status_code == 200
+    assert response.text == ""
+
+
+def test_compression(client):
+    headers = {"Accept-Encoding": "gzip"}
+    response = client.post("/analyze", json={"text": TEXT}, headers=headers)
+    assert response.headers.get("content-encoding") in ("gzip", "br")
+    # SSE must reach the client event by event, so it is never compressed
+    response = client.post("/generate_stream", json={"text": TEXT, "max_new_tokens": 8}, headers=headers)
+    assert response.status_code == 200
+    assert "content-encoding" not in response.headers
+
+
+def test_prefix_kv_reuse_matches_full_forward(app_module):
+    input_ids = app_module._tokenize(TEXT)["input_ids"][0].tolist()
+    app_module.PREFIX_KV.clear()
+    app_module._next_token_logits(input_ids[:5])
+    app_module._next_token_logits(input_ids[:6])  # hit on input_ids[:5]
+    logits = app_module._next_token_logits(input_ids[:7])  # hit on input_ids[:6]
+    torch.testing.assert_close(logits, _full_forward_logits(app_module, input_ids[1:8]), atol=1e-4, rtol=1e-4)
+
+
+def test_batched_misses_match_full_forward(app_module):
+    input_ids = app_module._tokenize(TEXT)["input_ids"][0].tolist()
+    app_module.PREFIX_KV.clear()
+    short, long = input_ids[:4], input_ids[:9]
+    short_logits, long_logits = app_module._next_token_logits_batch([short, long])
+    torch.testing.assert_close(short_logits, _full_forward_logits(app_module, short), atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(long_logits, _full_forward_logits(app_module, long), atol=1e-4, rtol=1e-4)
+    # The per-row KV slices stored by the batch must be reusable
+    extended = input_ids[:5]
+    torch.testing.assert_close(
+        app_module._next_token_logits(extended), _full_forward_logits(app_module, extended), atol=1e-4, rtol=1e-4
+    )
+
+
+def test_too_long_prompt_fails_alone_in_batch(app_module, client, monkeypatch):
+    input_ids = app_module._tokenize(TEXT)["input_ids"][0].tolist()
+    too_long = input_ids * (app_module.model.config.n_positions // len(input_ids) + 1)
+    app_module.PREFIX_KV.clear()
+    app_module._next_token_logits(input_ids[1:6])  # a prefix of neither miss
+    prefill_calls = []
+    prefill = app_module._prefill
+    monkeypatch.setattr(app_module, "_prefill", lambda ids, hit=None: prefill_calls.append(ids) or prefill(ids, hit))
+
+    async def dispatch():
+        monkeypatch.setattr(app_module, "_inference_slots", asyncio.Semaphore(app_module.N_PARALLEL))
+        loop = asyncio.get_running_loop()
+        batch = [(ids, loop.create_future()) for ids in (too_long, input_ids, input_ids[1:8])]
+        await app_module._dispatch_next_token_batch(batch)
+        return [fut for _, fut in batch]
+
+    bad, good, hit = asyncio.run(dispatch())
+    assert bad.exception() is not None
+    torch.testing.assert_close(good.result(), _full_forward_logits(app_module, input_ids), atol=1e-4, rtol=1e-4)
+    torch.testing.assert_close(hit.result(), _full_forward_logits(app_module, input_ids[1:8]), atol=1e-4, rtol=1e-4)
+    # The prefix hit ran once; only the two misses were retried after the padded batch failed
+    assert prefill_calls == [input_ids[1:8], too_long, input_ids]
+    # The endpoint rejects it before it can reach a batch
+    data = client.post("/next_token", json={"text": app_module.tokenizer.decode(too_long)}).json()
+    assert data["token_id"] == -1
+
+
+def test_cached_next_token_logits_own_their_storage(app_module):
+    run = app_module._forward(app_module._tokenize(TEXT))
+    logits = run.next_token_logits
+    # A view into the [1, seq_len, vocab] logits would pin all of them in the output cache
+    assert logits.untyped_storage().nbytes() == logits.numel() * logits.element_size()
+
+
+@pytest.mark.parametrize("length", [3, 17, 40])
+def test_traced_forward_matches_eager(app_module, length):
+    if not app_module._traced:
+        pytest.skip("jit trace fell back to eager on this transformers/torch")
+    input_ids = torch.arange(length).unsqueeze(0) % 300
+    run = app_module._forward({"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)})
+    with torch.inference_mode():
+        eager = app_module.model(input_ids, output_hidden_states=True, output_attentions=True)
+    torch.testing.assert_close(run.next_token_logits, eager.logits[0, -1].float(), atol=1e-4, rtol=1e-4)
+    for traced_layer, eager_layer in zip(run.hidden_states, eager.hidden_states):
+        torch.testing.assert_close(traced_layer, eager_layer, atol=1e-4, rtol=1e-4)
+    for traced_layer, eager_layer in zip(run.attentions, eager.attentions):
+        torch.testing.assert_close(traced_layer, eager_layer, atol=1e-4, rtol=1e-4)
+
+
+def test_output_cache_is_bounded_by_bytes(app_module, monkeypatch):
+    run_bytes = app_module._nbytes(app_module._run_model(TEXT))
+    budget = int(run_bytes * 1.5)
+    monkeypatch.setattr(app_module, "_model_runs", app_module.LRUCache(maxsize=budget, getsizeof=app_module._nbytes))
+    app_module._run_model(TEXT)
+    app_module._run_model(TEXT + " Rome")
+    assert len(app_module._model_runs) == 1
+    assert app_module._model_runs.currsize <= budget
+    # Runs over the whole budget are returned but not cached
+    app_module._run_model(TEXT * 8)
+    assert app_module._model_runs.currsize <= budget
+
+
+def test_prefix_kv_is_bounded_by_tokens(app_module, monkeypatch):
+    input_ids = app_module._tokenize(TEXT)["input_ids"][0].tolist()
+    monkeypatch.setattr(app_module, "PREFIX_KV_MAX_TOKENS", 12)
+    app_module.PREFIX_KV.clear()
+    for length in (3, 4, 5, 6):
+        app_module._next_token_logits(input_ids[:length])
+    assert sum(map(len, app_module.PREFIX_KV)) <= 12
+    assert list(map(len, app_module.PREFIX_KV)) == [5, 6]  # least recently used evicted first
+    assert app_module._lookup_prefix_kv(input_ids[:9])[0] == 6
+    assert app_module._lookup_prefix_kv(input_ids[:6])[0] == 5  # proper prefixes only
+
+
+def test_pca_3d_matches_exact_svd(app_module):
+    torch.manual_seed(1)
+    # Decaying spectrum, where an un-oversampled randomized SVD drifts from the top components
+    basis = torch.linalg.qr(torch.randn(64, 64))[0]
+    hidden = (torch.randn(40, 64) * 0.8 ** torch.arange(64)) @ basis.T
+    app_module._embeddings3d.clear()
+    projection = torch.tensor(app_module._pca_3d("pca test", hidden.unsqueeze(0)))
+    app_module._embeddings3d.clear()
+    assert app_module._pca_3d("pca test", hidden.unsqueeze(0)) == projection.tolist()  # deterministic
+    centered = hidden - hidden.mean(dim=0)
+    exact = centered @ torch.linalg.svd(centered, full_matrices=False).Vh[:3].T
+    # Components match the exact ones up to sign
+    torch.testing.assert_close(projection.abs(), exact.abs(), atol=1e-3, rtol=1e-3)
+
+
+def test_conv1d_to_linear_matches_original(app_module):
+    model = _stub_model(attn_implementation="eager").eval()
+    input_ids = app_module._tokenize(TEXT)["input_ids"]
+    with torch.inference_mode():
+        expected = model(input_ids, output_attentions=True)
+    app_module._conv1d_to_linear(model)
+    assert not any(isinstance(module, app_module.Conv1D) for module in model.modules())
+    with torch.inference_mode():
+        swapped = model(input_ids, output_attentions=True)
+    torch.testing.assert_close(swapped.logits, expected.logits)
+    for swapped_layer, expected_layer in zip(swapped.attentions, expected.attentions):
+        torch.testing.assert_close(swapped_layer, expected_layer)
+
+    if set(torch.backends.quantized.supported_engines) <= {"none"}:
+        pytest.skip("no quantization engine available")
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    with torch.inference_mode():
+        logits = quantized(input_ids).logits
+    assert logits.shape == expected.logits.shape
+    assert torch.isfinite(logits).all()
@@ -1,5 +1,5 @@
 import React, { useState, useCallback, useEffect } from "react";
-import { fetchTokenData, fetchEmbeddings, fetchAttention, fetchNextToken } from "./api";
+import { fetchTokenData, fetchAnalysis } from "./api";
 import { LLMStoryController } from "./components/LLMStoryController";
 import { LoadingOverlay } from "./components/LoadingOverlay";
 import { ErrorBoundary } from "./components/ErrorBoundary";
@@ -66,13 +66,15 @@ function App() {
     setLoading(true);
     resetState();
     try {
-      // Fetch all data in parallel for better performance
-      const [tokenResult, embResult, attResult, nextResult] = await Promise.all([
+      // Fetch all data in parallel; /analyze runs the model once for
+      // embeddings, attention and next token prediction
+      const [tokenResult, analysis] = await Promise.all([
         fetchTokenData(inputText),
-        fetchEmbeddings(inputText),
-        fetchAttention(inputText),
-        fetchNextToken(inputText)
+        fetchAnalysis(inputText)
       ]);
+      const embResult = { num_layers: analysis?.hidden_states?.length, hidden_states: analysis?.hidden_states, embeddings3d: analysis?.embeddings3d };
+      const attResult = { num_layers: analysis?.num_layers, attentions: analysis?.attentions };
+      const nextResult = analysis?.next_token;
       // Validate responses
       if (!tokenResult?.tokens?.length) throw new Error("Invalid token data");
       if (!embResult?.hidden_states?.length) throw new Error("Invalid embedding data");
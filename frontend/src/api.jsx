@@ -12,6 +12,17 @@ const API_BASE = "http://localhost:8000"; // Change if needed
  * - Next token predictions with probabilities
  */
 
+/**
+ * Fetch attentions, hidden states, 3D embeddings and next token prediction
+ * from a single backend forward pass
+ * @param {string} text - Input text to analyze
+ * @returns {Promise<Object>} Combined analysis with attentions, hidden_states, embeddings3d and next_token
+ */
+export const fetchAnalysis = async (text) => {
+  const response = await axios.post(`${API_BASE}/analyze`, { text });
+  return response.data;
+};
+
 /**
  * Fetch tokenization data for input text
  * @param {string} text - Input text to tokenize
@@ -42,6 +53,36 @@ export const fetchAttention = async (text) => {
   return response.data;
 };
 
+/**
+ * Convert an IEEE 754 half-precision bit pattern to a JavaScript number
+ * @param {number} h - 16-bit float bits
+ * @returns {number} Decoded value
+ */
+const halfToFloat = (h) => {
+  const sign = h & 0x8000 ? -1 : 1;
+  const exponent = (h >> 10) & 0x1f;
+  const fraction = h & 0x03ff;
+  if (exponent === 0) return sign * Math.pow(2, -14) * (fraction / 1024);
+  if (exponent === 31) return fraction ? NaN : sign * Infinity;
+  return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+};
+
+/**
+ * Fetch attention weights as a binary FP16 payload (much smaller than JSON)
+ * @param {string} text - Input text to analyze attention for
+ * @returns {Promise<Object>} { shape: [layers, heads, seq, seq], data: Float32Array } in row-major order
+ */
+export const fetchAttentionBinary = async (text) => {
+  const response = await axios.post(`${API_BASE}/attention_bin`, { text }, { responseType: "arraybuffer" });
+  const shape = (response.headers["x-shape"] || "0,0,0,0").split(",").map(Number);
+  const halves = new Uint16Array(response.data);
+  const data = new Float32Array(halves.length);
+  for (let i = 0; i < halves.length; i++) {
+    data[i] = halfToFloat(halves[i]);
+  }
+  return { shape, data };
+};
+
 /**
  * Fetch next token prediction for input text
  * @param {string} text - Input text to predict next token for